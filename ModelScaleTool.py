@@ -1,22 +1,23 @@
 # Copyright (c) 2019 Ultimaker B.V.
 # Uranium is released under the terms of the LGPLv3 or higher.
 
-import time
+import re
 from typing import cast, List, Optional, Union
 
+import numpy
+
 from PyQt5.QtCore import Qt, QTimer
 
-from UM.Event import Event, MouseEvent, KeyEvent
-from UM.Math.Float import Float
-from UM.Math.Plane import Plane
+from UM.Event import Event, KeyEvent
+from UM.Math.Matrix import Matrix
 from UM.Math.Vector import Vector
 from UM.Operations.GroupedOperation import GroupedOperation
-from UM.Operations.TranslateOperation import TranslateOperation
+from UM.Operations.Operation import Operation
+from UM.Operations.ScaleOperation import ScaleOperation
 from UM.Scene.SceneNodeSettings import SceneNodeSettings
 from UM.Scene.Selection import Selection
 from UM.Scene.ToolHandle import ToolHandle
 from UM.Tool import Tool
-from UM.Logger import Logger #Adding messages to the log.
 
 try:
     from . import ModelScaleToolHandle
@@ -27,6 +28,40 @@ except (ImportError, SystemError):
 DIMENSION_TOLERANCE = 0.0001  # Tolerance value used for comparing dimensions from the UI.
 DIRECTION_TOLERANCE = 0.0001  # Used to check if you're perpendicular on some axis
 
+# Matches the "desired/start" pair sent by the QML, e.g. "1/6.5". Rejecting
+# malformed input up front is much cheaper than catching ValueError twice.
+_SCALE_PAIR_RE = re.compile(r"^\s*([-+0-9.eE]+)\s*/\s*([-+0-9.eE]+)\s*$")
+
+# From this many selected nodes on, scale the transformations in one vectorized
+# NumPy pass instead of one ScaleOperation per node.
+VECTORIZED_SCALE_THRESHOLD = 50
+
+# The setting API stores strings; share the two bool spellings instead of
+# calling str() per node.
+_TRUE_STR = "True"
+_FALSE_STR = "False"
+
+
+class _SetTransformationOperation(Operation):
+    """Operation that swaps a node's local transformation between two
+    precomputed matrices.
+
+    Used by the vectorized scale path, where the new matrices are computed in
+    one NumPy pass instead of per node, so the conversion stays undoable.
+    """
+
+    def __init__(self, node, old_transformation: Matrix, new_transformation: Matrix) -> None:
+        super().__init__()
+        self._node = node
+        self._old_transformation = old_transformation
+        self._new_transformation = new_transformation
+
+    def undo(self) -> None:
+        self._node.setTransformation(self._old_transformation)
+
+    def redo(self) -> None:
+        self._node.setTransformation(self._new_transformation)
+
 
 class ModelScaleTool(Tool):
     """Provides the tool to move meshes and groups.
@@ -49,12 +84,29 @@ class ModelScaleTool(Tool):
         self._distance_update_time = None #type: Optional[float]
         self._distance = None #type: Optional[Vector]
 
+        # The distance the hint below was formatted from; ToolHint is polled
+        # often, so only redo the sqrt + formatting when the distance changes.
+        self._tool_hint_distance = None #type: Optional[Vector]
+        self._tool_hint_text = None #type: Optional[str]
+
+        # Nodes whose boundingBoxChanged signal we are currently connected to,
+        # so repeated activate events can't stack duplicate connections.
+        self._connected_nodes = set()
+
+        # Selected nodes without selected ancestors; walking the scene tree for
+        # them is O(nodes * depth), so keep the list until the selection changes.
+        self._cached_selected_nodes = None #type: Optional[List]
+
+        # Last successfully parsed starting scale, so a single-value input
+        # doesn't need to re-send (and re-parse) it.
+        self._start_scale = 1.0
+
         self.setExposedProperties("ToolHint",
                                   "X", "Y", "Z",
                                   SceneNodeSettings.LockPosition)
 
         self._update_selection_center_timer = QTimer()
-        self._update_selection_center_timer.setInterval(50)
+        self._update_selection_center_timer.setInterval(200)
         self._update_selection_center_timer.setSingleShot(True)
         self._update_selection_center_timer.timeout.connect(self.propertyChanged.emit)
 
@@ -62,79 +114,120 @@ class ModelScaleTool(Tool):
         Selection.selectionCenterChanged.connect(self._onSelectionCenterChanged)
 
         # CURA-5966 Make sure to render whenever objects get selected/deselected.
-        Selection.selectionChanged.connect(self.propertyChanged)
+        # Routed through _onSelectionChanged, which invalidates the caches and
+        # then defers to the throttled slot, so rapid (de)selections coalesce
+        # into a single propertyChanged instead of one per click.
+        Selection.selectionChanged.connect(self._onSelectionChanged)
 
     def _onSelectionCenterChanged(self):
+        # Leading-edge throttle: update the properties right away, then use the
+        # timer as a cool-down so a drag only re-evaluates the QML at ~5 Hz.
+        if not self._update_selection_center_timer.isActive():
+            self.propertyChanged.emit()
         self._update_selection_center_timer.start()
 
+    def _onSelectionChanged(self) -> None:
+        # Invalidate before notifying, so the property re-read triggered by the
+        # leading-edge emit sees the new selection rather than the cached one.
+        self._cached_selected_nodes = None
+        self._onSelectionCenterChanged()
+
+    def _getSelectedNodesCached(self) -> List:
+        """Get the selected nodes without selected ancestors, cached until the
+        selection changes.
+        """
+        if self._cached_selected_nodes is None:
+            self._cached_selected_nodes = self._getSelectedObjectsWithoutSelectedAncestors()
+        return self._cached_selected_nodes
+
     def getX(self) -> float:
-        """Get the x-location of the selection bounding box center.
+        """Get the default starting scale shown in the tool panel.
 
-        :return: X location in mm.
+        :return: Starting scale denominator.
         """
-        '''
-        if Selection.hasSelection():
-            return float(Selection.getBoundingBox().center.x)
-        '''
         return 6.0
 
     def getY(self) -> float:
-        """Get the y-location of the selection bounding box center.
+        """Get the default desired scale shown in the tool panel.
 
-        :return: Y location in mm.
-        
-        if Selection.hasSelection():
-            # Note; The switching of z & y is intentional. We display z as up for the user,
-            # But store the data in openGL space.
-            return float(Selection.getBoundingBox().center.z)
+        :return: Desired scale denominator.
         """
-        
         return 1.0
 
     def getZ(self) -> float:
-        """Get the z-location of the selection bounding box bottom
+        """Get the Z property. Unused by the tool panel, but exposed.
 
-        The bottom is used as opposed to the center, because the biggest use
-        case is to push the selection into the build plate.
-        :return: Z location in mm.
-        
-        # We want to display based on the bottom instead of the actual coordinate.
-        if Selection.hasSelection():
-            # Note; The switching of z & y is intentional. We display z as up for the user,
-            # But store the data in openGL space.
-            return float(Selection.getBoundingBox().bottom)
+        :return: Placeholder value.
         """
         return 1.0
 
     @staticmethod
     def _parseFloat(str_value: str) -> float:
+        str_value = str_value.strip() if str_value else ""
+        if not str_value:
+            return 0.0  # Empty field while typing; skip the exception machinery.
         try:
-            parsed_value = float(str_value)
+            return float(str_value)
         except ValueError:
-            parsed_value = float(0)
-        return parsed_value
+            return 0.0
 
 
         
     def setModelScale(self, y: str) -> None:
-        splitInput =  y.split("/")
-        parsed_Desired = abs(self._parseFloat(splitInput[0]))#take absolute value so dont have to worry about accidental negatives
-        parsed_Start = abs(self._parseFloat(splitInput[1]))
-        bounding_box = Selection.getBoundingBox()
-
-        if (parsed_Desired * parsed_Start)!=0: # Multiply both values together to make sure neither are 0
-            selected_nodes = self._getSelectedObjectsWithoutSelectedAncestors()
-            if len(selected_nodes) > 1:
+        match = _SCALE_PAIR_RE.match(y)
+        if match:
+            try:
+                parsed_Desired = abs(float(match.group(1)))#take absolute value so dont have to worry about accidental negatives
+                parsed_Start = abs(float(match.group(2)))
+            except ValueError:
+                return  # The character class still lets through e.g. "1.2.3".
+        elif "/" not in y:
+            # A lone value only updates the desired scale; reuse the starting
+            # scale from the previous conversion.
+            parsed_Desired = abs(self._parseFloat(y))
+            parsed_Start = self._start_scale
+        else:
+            return  # Malformed input; bail out before touching the scene.
+        if parsed_Desired == 0 or parsed_Start == 0:
+            return  # Unusable input; bail out before touching the scene.
+        self._start_scale = parsed_Start
+
+        selected_nodes = self._getSelectedNodesCached()
+        if not selected_nodes:
+            return  # Nothing to scale; don't push an empty undo entry.
+        scale_factor = parsed_Start / parsed_Desired
+        scale_vector = Vector(scale_factor, scale_factor, scale_factor)
+
+        # Silence the per-node property updates while the batch is applied;
+        # a single propertyChanged afterwards is enough for the QML.
+        for node in self._connected_nodes:
+            node.boundingBoxChanged.disconnect(self.propertyChanged)
+        try:
+            if len(selected_nodes) >= VECTORIZED_SCALE_THRESHOLD:
+                # For huge selections the per-node matrix multiplication
+                # dominates, so compute all new transformations in one NumPy
+                # pass and push them as old/new swaps; still one undo entry.
+                old_transformations = [node.getLocalTransformation() for node in selected_nodes]
+                matrices = numpy.stack([transformation.getData() for transformation in old_transformations])
+                matrices[:, :3, :3] *= scale_factor
                 op = GroupedOperation()
-                # add functionality for more than one object at a time
+                for selected_node, old_transformation, matrix_data in zip(selected_nodes, old_transformations, matrices):
+                    op.addOperation(_SetTransformationOperation(selected_node, old_transformation, Matrix(matrix_data)))
+                op.push()
             else:
+                # Group the scale of every node into one operation, so scaling
+                # many objects only triggers a single undo entry and a single
+                # render.
+                op = GroupedOperation()
                 for selected_node in selected_nodes:
-                    SCALE_FACTOR = (parsed_Start)/(parsed_Desired)
-                    selected_node.scale(Vector(SCALE_FACTOR,SCALE_FACTOR,SCALE_FACTOR))
-                    #OUTSTR = "SCALE_FACTOR is: "+ str(SCALE_FACTOR)+ " by factoring start: "+str(START_SCALE)+" and desired:" +str(DESIRED_SCALE)
-                    #Logger.log("i", OUTSTR)
-            
-            self._controller.toolOperationStopped.emit(self)
+                    op.addOperation(ScaleOperation(selected_node, scale_vector))
+                op.push()
+        finally:
+            for node in self._connected_nodes:
+                node.boundingBoxChanged.connect(self.propertyChanged)
+            self.propertyChanged.emit()
+
+        self._controller.toolOperationStopped.emit(self)
 
     def setEnabledAxis(self, axis: List[int]) -> None:
         """Set which axis/axes are enabled for the current translate operation
@@ -151,28 +244,23 @@ class ModelScaleTool(Tool):
         model movement on the build plate.
         :param value: The setting state.
         """
-        for selected_node in self._getSelectedObjectsWithoutSelectedAncestors():
-            selected_node.setSetting(SceneNodeSettings.LockPosition, str(value))
+        for selected_node in self._getSelectedNodesCached():
+            selected_node.setSetting(SceneNodeSettings.LockPosition, _TRUE_STR if value else _FALSE_STR)
 
     def getLockPosition(self) -> Union[str, bool]:
-        total_size = Selection.getCount()
-        false_state_counter = 0
-        true_state_counter = 0
         if not Selection.hasSelection():
             return False
 
-        for selected_node in self._getSelectedObjectsWithoutSelectedAncestors():
-            if selected_node.getSetting(SceneNodeSettings.LockPosition, "False") != "False":
-                true_state_counter += 1
+        seen_locked = False
+        seen_unlocked = False
+        for selected_node in self._getSelectedNodesCached():
+            if selected_node.getSetting(SceneNodeSettings.LockPosition, _FALSE_STR) != _FALSE_STR:
+                seen_locked = True
             else:
-                false_state_counter += 1
-
-        if total_size == false_state_counter:  # No locked positions
-            return False
-        elif total_size == true_state_counter:  # All selected objects are locked
-            return True
-        else:
-            return "partially"  # At least one, but not all are locked
+                seen_unlocked = True
+            if seen_locked and seen_unlocked:
+                return "partially"  # At least one, but not all are locked
+        return seen_locked  # Either all locked (True) or none locked (False)
 
     def event(self, event: Event) -> bool:
         """Handle mouse and keyboard events.
@@ -185,12 +273,18 @@ class ModelScaleTool(Tool):
 
         # Make sure the displayed values are updated if the bounding box of the selected mesh(es) changes
         if event.type == Event.ToolActivateEvent:
-            for node in self._getSelectedObjectsWithoutSelectedAncestors():
+            for node in self._getSelectedNodesCached():
+                if node in self._connected_nodes:
+                    continue  # A second connect would make the slot fire twice per change.
                 node.boundingBoxChanged.connect(self.propertyChanged)
+                self._connected_nodes.add(node)
 
         if event.type == Event.ToolDeactivateEvent:
-            for node in self._getSelectedObjectsWithoutSelectedAncestors():
+            # Tear down from the tracked set rather than the current selection;
+            # the selection may have changed since the nodes were connected.
+            for node in self._connected_nodes:
                 node.boundingBoxChanged.disconnect(self.propertyChanged)
+            self._connected_nodes.clear()
 
         if event.type == Event.KeyPressEvent and cast(KeyEvent, event).key == KeyEvent.ShiftKey:
             return False
@@ -205,4 +299,7 @@ class ModelScaleTool(Tool):
         :return: Fully formatted string showing the distance by which the
         mesh(es) are dragged.
         """
-        return "%.2f mm" % self._distance.length() if self._distance else None
+        if self._distance is not self._tool_hint_distance:
+            self._tool_hint_distance = self._distance
+            self._tool_hint_text = "%.2f mm" % self._distance.length() if self._distance else None
+        return self._tool_hint_text